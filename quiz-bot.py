@@ -1,9 +1,20 @@
 import logging
+import logging.handlers
+import atexit
+import queue
 import random
 import os
+import sys
 import asyncio
 import json
-from flask import Flask, request, Response
+import itertools
+import collections
+import re
+import signal
+import functools
+from array import array
+import pickle
+import orjson
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
@@ -17,7 +28,10 @@ from telegram.ext import (
     filters,
     TypeHandler # Needed for processing updates manually
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+import tornado.web
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from pymongo import MongoClient, errors as pymongo_errors
 from datetime import datetime, timedelta # For subscription expiry
@@ -50,16 +64,41 @@ WEBHOOK_FULL_URL = f"{WEBHOOK_URL_BASE}/{WEBHOOK_PATH}" if WEBHOOK_URL_BASE else
 
 # Quiz file and batch size
 QUIZ_FILE = 'tests.txt'
+QUIZ_CACHE_SUFFIX = '.pkl' # Parsed questions are cached next to the quiz file
+QUIZ_CACHE_VERSION = 8 # Bump when the shape of parsed questions changes
+QUIZ_READ_BUFFER_SIZE = 1 << 17 # 128 KiB; reads the quiz file in a few syscalls instead of 8 KiB at a time
+OPTION_LINE_RE = re.compile(r"[^\W\d_]\).") # "A) text": a letter, ')' and at least one more character
+ANSWER_LINE_RE = re.compile(r"Answer:\s*([^\W\d_])\s*") # "Answer: B", matched against the whole line
 QUESTIONS_PER_BATCH = 10
+RANDOM_MIX_SIZE = 50 # Questions in a "Random" quiz drawn from all subjects
+SEND_CHUNK_SIZE = 8 # Questions of a batch are sent concurrently, this many at a time
+SEND_CHUNK_DELAY = 0.05 # Seconds between chunks, keeps bursts under Telegram's rate limits
+SEND_MAX_RETRIES = 3 # Times a question is re-sent after Telegram's flood control (429) asks to wait
+MAX_QUIZ_QUESTIONS = 1 << 16 # Question ids are kept in array('H') and sent as 4 hex digits in answer callbacks
+
+# Quiz sessions are kept in memory, bounded in count and dropped after this long without activity
+QUIZ_SESSION_MAX_USERS = 10_000
+QUIZ_SESSION_IDLE_TTL = 3600 # Seconds
+
+# Log level name, e.g. WARNING in production to drop per-quiz INFO records
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 
 # === STATES for ConversationHandler ===
 SELECTING_SUBJECT, QUIZ_IN_PROGRESS = range(2)
 
 # === Logging Setup ===
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
-logging.getLogger("httpx").setLevel(logging.WARNING)
+# Handlers only enqueue records; a background listener thread writes them out,
+# so a slow stderr/log collector never blocks the event loop.
+log_queue = queue.SimpleQueue()
+log_output_handler = logging.StreamHandler()
+log_output_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_output_handler)
+log_listener.start()
+atexit.register(log_listener.stop) # Flushes queued records on exit
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+log_queue_handler.setFormatter(logging.Formatter("%(message)s")) # Only merges args; the listener adds timestamp etc.
+logging.basicConfig(handlers=[log_queue_handler], level=LOG_LEVEL)
+logging.getLogger("httpx").disabled = True # One record per Bot API call; failures surface as PTB errors
 logger = logging.getLogger(__name__)
 
 # === MONGODB CONFIGURATION ===
@@ -79,106 +118,243 @@ try:
     db = client[DB_NAME]
     paid_users_collection = db[PAID_USERS_COLLECTION_NAME]
     paid_users_collection.create_index("chat_id", unique=True) # Ensures chat_id is unique and indexed
-    logger.info(f"Successfully connected to MongoDB: {DB_NAME} and collection: {PAID_USERS_COLLECTION_NAME}")
+    logger.info("Successfully connected to MongoDB: %s and collection: %s", DB_NAME, PAID_USERS_COLLECTION_NAME)
 except pymongo_errors.ConnectionFailure as e:
-    logger.critical(f"Could not connect to MongoDB: {e}")
+    logger.critical("Could not connect to MongoDB: %s", e)
     exit() # Critical to have DB for paid features
 except Exception as e:
-    logger.critical(f"An error occurred during MongoDB setup: {e}")
+    logger.critical("An error occurred during MongoDB setup: %s", e)
     exit()
 
 
 # === Utils ===
+# A parsed question; smaller than a dict per question, and fields are read by offset instead of hashing
+Question = collections.namedtuple('Question', 'question options correct letters options_text feedback_texts')
+
 def load_questions(file_path):
-    """Loads questions from a text file into a dictionary by subject."""
+    """
+    Loads questions by subject, reusing the pickled cache next to the quiz file
+    while the quiz file is unchanged. Falls back to parsing the text file.
+    """
+    try:
+        file_stat = os.stat(file_path)
+    except FileNotFoundError:
+        logger.error("Error: Quiz file not found at %s", file_path)
+        return {}
+
+    cache_path = file_path + QUIZ_CACHE_SUFFIX
+    cache_key = (QUIZ_CACHE_VERSION, file_stat.st_mtime_ns, file_stat.st_size)
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('key') == cache_key:
+            subjects = {sys.intern(subject): questions for subject, questions in cached['subjects'].items()} # Unpickled keys aren't interned
+            logger.info("Loaded subjects from cache %s: %s", cache_path, list(subjects.keys()))
+            return subjects
+        logger.info("Question cache %s is stale. Re-parsing %s.", cache_path, file_path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("Could not read question cache %s: %s. Re-parsing %s.", cache_path, e, file_path)
+
+    subjects = parse_questions_file(file_path)
+    if subjects:
+        tmp_path = cache_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'key': cache_key, 'subjects': subjects}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path) # Atomic, so readers never see a partial cache
+        except (OSError, pickle.PicklingError) as e:
+            logger.warning("Could not write question cache %s: %s", cache_path, e)
+    return subjects
+
+def parse_questions_file(file_path):
+    """
+    Parses questions from a text file into a dictionary by subject.
+    The file is read line by line; only the current blank-line separated block is kept in memory.
+    """
     subjects = {}
+    current_subject = None
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        with open(file_path, 'r', encoding='utf-8', buffering=QUIZ_READ_BUFFER_SIZE) as f:
+            lines = []
+            for line in itertools.chain(f, ['']): # The trailing '' flushes the last block
+                line = line.rstrip('\n')
+                if line.strip():
+                    if len(lines) < 6: # A question block never uses more than its first 6 lines
+                        lines.append(line if lines else line.lstrip())
+                elif lines:
+                    current_subject = parse_question_block(lines, subjects, current_subject)
+                    lines.clear() # parse_question_block keeps no reference to the list itself
     except FileNotFoundError:
-        logger.error(f"Error: Quiz file not found at {file_path}")
+        logger.error("Error: Quiz file not found at %s", file_path)
         return subjects
 
-    current_subject = None
-    blocks = content.replace('\r\n', '\n').strip().split('\n\n')
-
-    for block in blocks:
-        lines = block.strip().split('\n')
-        if lines[0].startswith("Subject:"):
-            try:
-                current_subject = lines[0].split(":", 1)[1].strip()
-                if current_subject:
-                    subjects[current_subject] = []
-                    logger.info(f"Found subject: {current_subject}")
-                else:
-                    logger.warning(f"Found empty subject name in block: {block}")
-                    current_subject = None
-            except IndexError:
-                logger.warning(f"Malformed Subject line: {lines[0]}")
-                current_subject = None
-            continue
+    logger.info("Loaded subjects: %s", list(subjects.keys()))
+    if not subjects:
+        logger.warning("No subjects were loaded. Check tests.txt format and content.")
+    return subjects
 
-        if current_subject is None:
-            logger.warning(f"Skipping block due to missing subject context: {block}")
-            continue
+def parse_question_block(lines, subjects, current_subject):
+    """
+    Parses one block (a Subject line or a question with 4 options and an Answer line) into `subjects`.
+    Returns the subject that following blocks belong to.
+    """
+    if lines[0].startswith("Subject:"):
+        current_subject = sys.intern(lines[0].partition(":")[2].strip()) # Subject names are dict keys for the bot's lifetime
+        if current_subject:
+            subjects[current_subject] = []
+            logger.info("Found subject: %s", current_subject)
+        else:
+            logger.warning("Found empty subject name in block: %s", lines)
+            current_subject = None
+        return current_subject
 
-        if len(lines) < 6:
-            logger.warning(f"Skipping malformed block (less than 6 lines) for subject '{current_subject}': {block}")
-            continue
+    if current_subject is None:
+        logger.warning("Skipping block due to missing subject context: %s", lines)
+        return current_subject
 
-        if current_subject not in subjects:
-            logger.error(f"Internal logic error: Subject '{current_subject}' not initialized.")
-            continue
+    if len(lines) < 6:
+        logger.warning("Skipping malformed block (less than 6 lines) for subject '%s': %s", current_subject, lines)
+        return current_subject
 
-        try:
-            question_text = lines[0]
-            options = lines[1:5]
-            answer_line = lines[5]
-
-            if not all(len(opt) > 2 and opt[1] == ')' and opt[0].isalpha() for opt in options):
-                logger.warning(f"Malformed options format in block for subject '{current_subject}': {options}")
-                continue
-            if not answer_line.startswith("Answer:"):
-                logger.warning(f"Malformed answer line format for subject '{current_subject}': {answer_line}")
-                continue
-
-            correct_answer_letter = answer_line.split(":", 1)[1].strip()
-            if not correct_answer_letter or len(correct_answer_letter) != 1 or not correct_answer_letter.isalpha():
-                logger.warning(f"Invalid correct answer letter '{correct_answer_letter}' for subject '{current_subject}': {answer_line}")
-                continue
-
-            subjects[current_subject].append({
-                'question': question_text,
-                'options': options,
-                'correct': correct_answer_letter.upper()
-            })
-        except IndexError:
-            logger.warning(f"Skipping block due to parsing error (IndexError) for subject '{current_subject}': {block}")
-        except Exception as e:
-            logger.error(f"Unexpected error parsing block for subject '{current_subject}': {e}\nBlock: {block}", exc_info=True)
+    if current_subject not in subjects:
+        logger.error("Internal logic error: Subject '%s' not initialized.", current_subject)
+        return current_subject
 
-    logger.info(f"Loaded subjects: {list(subjects.keys())}")
-    if not subjects:
-        logger.warning("No subjects were loaded. Check tests.txt format and content.")
-    return subjects
+    try:
+        question_text = lines[0]
+        options = tuple(lines[1:5]) # Read-only from here on
+        answer_line = lines[5]
+
+        if not all(map(OPTION_LINE_RE.match, options)):
+            logger.warning("Malformed options format in block for subject '%s': %s", current_subject, options)
+            return current_subject
+        answer_match = ANSWER_LINE_RE.fullmatch(answer_line)
+        if not answer_match:
+            if answer_line.startswith("Answer:"):
+                logger.warning("Invalid correct answer letter for subject '%s': %s", current_subject, answer_line)
+            else:
+                logger.warning("Malformed answer line format for subject '%s': %s", current_subject, answer_line)
+            return current_subject
+
+        correct_answer_letter = answer_match.group(1).upper()
+        letters = tuple(opt[0].upper() for opt in options)
+        if len(correct_answer_letter) != 1 or any(len(letter) != 1 for letter in letters):
+            # Buttons carry exactly one letter, but e.g. 'ß'.upper() == 'SS'
+            logger.warning("Skipping block with option letters that don't uppercase to a single character for subject '%s': %s", current_subject, lines)
+            return current_subject
+        options_text = "\n".join(options)
+
+        subjects[current_subject].append(Question(
+            question=question_text,
+            options=options,
+            correct=correct_answer_letter,
+            letters=letters, # Answer button labels, built once at load time
+            options_text=options_text, # Options as shown in question and feedback messages
+            feedback_texts=build_feedback_texts(question_text, options, options_text, correct_answer_letter)
+        ))
+    except IndexError:
+        logger.warning("Skipping block due to parsing error (IndexError) for subject '%s': %s", current_subject, lines)
+    except Exception as e:
+        logger.error("Unexpected error parsing block for subject '%s': %s\nBlock: %s", current_subject, e, lines, exc_info=True)
+    return current_subject
 
-# === Helper Function for Start Keyboard ===
-def get_start_keyboard(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup | None:
+def build_feedback_texts(question_text: str, options: tuple, options_text: str, correct_answer_letter: str) -> dict:
+    """
+    Returns the answered-question message for each option letter, without the "N. " position prefix.
+    Built once per question at load time, so answering only has to prepend the position.
+    """
+    options_by_letter = {opt[0].upper(): opt for opt in options}
+    correct_option_text = options_by_letter.get(correct_answer_letter, f"({correct_answer_letter})")
+    feedback_texts = {}
+    for letter, selected_option_text in options_by_letter.items():
+        feedback = "✅ To'g'ri!" if letter == correct_answer_letter else f"❌ Xato! To'g'ri javob: {correct_option_text}"
+        feedback_texts[letter] = (
+            f"{question_text}\n\n"
+            f"{options_text}\n\n"
+            f"--------------------\n"
+            f"{feedback}\n"
+            f"Siz tanladingiz: {selected_option_text}"
+        )
+    return feedback_texts
+
+# === Quiz Session State ===
+class QuizSession:
+    """Quiz progress of a single user, stored in `quiz_sessions` by user id."""
+    __slots__ = ('subject', 'question_ids', 'index', 'score', 'batch_start', 'batch_len', 'answered_mask', 'scored_questions', 'selected_letters', 'unsent_count')
+
+    def __init__(self, subject: str, question_ids: array):
+        self.subject = subject
+        self.question_ids = question_ids # Indices into bot_data['questions_flat'], in the order they are asked
+        self.index = 0 # Index of the first question of the next batch
+        self.score = 0
+        self.batch_start = 0 # Index of the first question of the current batch
+        self.batch_len = 0
+        self.answered_mask = 0 # Bit i is set once question batch_start + i is answered
+        self.scored_questions = set() # Question indices whose first answer was scored; later taps never change the score
+        self.selected_letters = {} # Last option letter chosen per question index
+        self.unsent_count = 0 # Questions that could not be delivered; left out of the final score
+
+# Unlike context.user_data, which keeps every user's data for the process lifetime,
+# abandoned quizzes expire here and the number of live sessions is capped.
+quiz_sessions = TTLCache(maxsize=QUIZ_SESSION_MAX_USERS, ttl=QUIZ_SESSION_IDLE_TTL)
+
+def get_quiz_session(user_id: int) -> QuizSession | None:
+    """Returns the user's active quiz session, if any, and restarts its idle timeout."""
+    session = quiz_sessions.get(user_id)
+    if session is not None:
+        quiz_sessions[user_id] = session
+    return session
+
+# === Answer Callback Data ===
+def encode_answer_callback(qid: int, letter: str) -> str:
+    """Packs a question index (< 65536) and option letter as 'a' + 4 hex digits + letter."""
+    return f"a{qid:04x}{letter}"
+
+ANSWER_CALLBACK_HEX_DIGITS = frozenset("0123456789abcdef") # int(..., 16) alone would accept "-001", "+001", "0x1f", " 1f "
+
+def decode_answer_callback(data: str) -> tuple[int, str]:
+    """Unpacks (question index, option letter) from encode_answer_callback data. Raises ValueError if malformed."""
+    if len(data) != 6 or not ANSWER_CALLBACK_HEX_DIGITS.issuperset(data[1:5]) or not data[5].isalpha():
+        raise ValueError(f"Answer callback data must be 'a' + 4 lowercase hex digits + letter, got {data!r}")
+    return int(data[1:5], 16), data[5]
+
+# === Helper Function for Answer Keyboards ===
+@functools.lru_cache(maxsize=4096)
+def get_answer_keyboard(qid: int, letters: tuple) -> InlineKeyboardMarkup:
+    """
+    Returns the answer buttons for the question at position `qid` of a quiz.
+    The markup only depends on the position and the option letters, so one (immutable) instance is shared by all users.
+    """
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(text=option_letter, callback_data=encode_answer_callback(qid, option_letter))
+        for option_letter in letters
+    ]])
+
+# The same for every user and batch, so a single (immutable) instance is shared
+NEXT_BATCH_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("Keyingi testlar", callback_data="n")]])
+
+# === Helper Functions for Start Keyboard ===
+def build_start_keyboard(loaded_subjects: dict) -> InlineKeyboardMarkup | None:
+    """Builds the subject selection keyboard. Called once at startup, the result is kept in bot_data['start_markup']."""
     known_subjects = ["osimlik-moyi" , "yogni-qayta-ishlash" , "oziq-ovqat-texnologiyasi" , "ATJ"] # These should match keys from tests.txt
     keyboard = []
-    loaded_subjects = context.bot_data.get('questions', {})
 
     for subj in known_subjects:
         if subj in loaded_subjects and loaded_subjects[subj]:
-            keyboard.append([InlineKeyboardButton(text=subj, callback_data=f"subj|{subj}")])
+            keyboard.append([InlineKeyboardButton(text=subj, callback_data=f"s|{subj}")])
         else:
-            logger.warning(f"Subject '{subj}' hardcoded but not loaded or has no questions. Skipping button.")
+            logger.warning("Subject '%s' hardcoded but not loaded or has no questions. Skipping button.", subj)
 
     if any(loaded_subjects.values()):
-        keyboard.append([InlineKeyboardButton(text="Random 50 savol", callback_data="random")])
+        keyboard.append([InlineKeyboardButton(text=f"Random {RANDOM_MIX_SIZE} savol", callback_data="r")])
 
     return InlineKeyboardMarkup(keyboard) if keyboard else None
 
+def get_start_keyboard(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup | None:
+    return context.bot_data.get('start_markup')
+
 # === Subscription Helper Function ===
 def is_user_subscribed(chat_id: int) -> bool:
     """Checks if a user is subscribed and their subscription is active."""
@@ -190,7 +366,7 @@ def is_user_subscribed(chat_id: int) -> bool:
         # Check for subscription expiry if the field exists and is not None
         if "subscription_expires_at" in user_doc and user_doc["subscription_expires_at"] is not None:
             if user_doc["subscription_expires_at"] < datetime.now():
-                logger.info(f"Subscription for chat_id {chat_id} has expired on {user_doc['subscription_expires_at']}.")
+                logger.info("Subscription for chat_id %s has expired on %s.", chat_id, user_doc['subscription_expires_at'])
                 # Optional: You could remove the user or mark them as expired in the DB
                 # paid_users_collection.delete_one({"chat_id": chat_id})
                 return False # Subscription expired
@@ -198,7 +374,7 @@ def is_user_subscribed(chat_id: int) -> bool:
         # If no expiry date, or if expiry date is in the future, they are subscribed
         return True
     except Exception as e:
-        logger.error(f"Error checking subscription status for chat_id {chat_id}: {e}")
+        logger.error("Error checking subscription status for chat_id %s: %s", chat_id, e)
         return False # Fail-safe: if there's an error, deny access
 
 # === Bot Handlers (Async v20 Style) ===
@@ -210,11 +386,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     user = update.effective_user
     chat_id = user.id
-    logger.info(f"User {user.id} ({user.first_name}) attempting /start.")
+    logger.info("User %s (%s) attempting /start.", user.id, user.first_name)
 
     if is_user_subscribed(chat_id):
-        logger.info(f"User {user.id} is subscribed. Proceeding to quiz selection.")
-        context.user_data.clear() # Clear previous quiz state for subscribed user
+        logger.info("User %s is subscribed. Proceeding to quiz selection.", user.id)
+        quiz_sessions.pop(user.id, None) # Clear previous quiz state for subscribed user
         
         reply_markup = get_start_keyboard(context)
         if not reply_markup:
@@ -230,7 +406,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return SELECTING_SUBJECT # Proceed to subject selection
     else:
-        logger.info(f"User {user.id} is not subscribed. Sending payment info.")
+        logger.info("User %s is not subscribed. Sending payment info.", user.id)
         await update.message.reply_text(
             f"Salom, {user.first_name}! 👋\n"
             "Bu botdagi quizlardan to'liq foydalanish uchun obuna bo'lishingiz kerak.\n\n"
@@ -314,11 +490,11 @@ async def add_subscriber_command(update: Update, context: ContextTypes.DEFAULT_T
             confirmation_text += "\nEndi quizlardan foydalanishingiz mumkin. /start buyrug'ini bering!"
             await context.bot.send_message(chat_id=target_chat_id, text=confirmation_text)
         except Exception as notify_error:
-            logger.error(f"Faollashtirish xabarini yuborishda xatolik {target_chat_id}: {notify_error}")
+            logger.error("Faollashtirish xabarini yuborishda xatolik %s: %s", target_chat_id, notify_error)
             await update.message.reply_text(f"(Foydalanuvchiga faollashtirish xabarini yuborib bo'lmadi: {str(notify_error)})")
 
     except Exception as e:
-        logger.error(f"/addsubscriber buyrug'ida xatolik: {e}")
+        logger.error("/addsubscriber buyrug'ida xatolik: %s", e)
         await update.message.reply_text("Xatolik yuz berdi. Bot loglarini tekshiring.")
 
 
@@ -328,228 +504,232 @@ async def start_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     data = query.data
     user_id = update.effective_user.id
 
-    context.user_data.clear()
-    logger.info(f"User {user_id} selected an option '{data}'. Cleared user_data before starting quiz.")
+    quiz_sessions.pop(user_id, None)
+    logger.debug("User %s selected an option '%s'. Cleared previous quiz session before starting quiz.", user_id, data)
 
-    all_loaded_questions = context.bot_data.get('questions', {})
+    subject_question_ids = context.bot_data.get('subject_question_ids', {})
     questions_to_ask = []
     subject_name = "Unknown"
 
-    if data.startswith("subj|"):
+    if data.startswith("s|"):
         subject_name = data.split("|", 1)[1]
-        if subject_name in all_loaded_questions and all_loaded_questions[subject_name]:
-            questions_to_ask = list(all_loaded_questions[subject_name])
-            random.shuffle(questions_to_ask)
-            logger.info(f"User {user_id} selected subject: {subject_name}, {len(questions_to_ask)} questions.")
+        if subject_question_ids.get(subject_name):
+            subject_ids = subject_question_ids[subject_name]
+            questions_to_ask = random.sample(subject_ids, k=len(subject_ids)) # Shuffled ids in one pass
+            logger.info("User %s selected subject: %s, %s questions.", user_id, subject_name, len(questions_to_ask))
         else:
-            logger.error(f"User {user_id} clicked button for subject '{subject_name}', but questions not loaded/empty.")
+            logger.error("User %s clicked button for subject '%s', but questions not loaded/empty.", user_id, subject_name)
             await query.edit_message_text(f"Kechirasiz, '{subject_name}' fani uchun savollarni yuklashda xatolik.")
             return ConversationHandler.END
-    elif data == "random":
+    elif data == "r":
         subject_name = 'Random Mix'
-        temp_list = []
-        if not any(all_loaded_questions.values()):
-            logger.error(f"User {user_id} requested random questions, but no subjects/questions loaded.")
+        random_mix_size = context.bot_data.get('random_mix_size', 0)
+        if not random_mix_size:
+            logger.error("User %s requested random questions, but no subjects/questions loaded.", user_id)
             await query.edit_message_text("Kechirasiz, aralashtirish uchun hech qanday savol mavjud emas.")
             return ConversationHandler.END
 
-        total_available = sum(len(qs) for qs in all_loaded_questions.values())
-        target_total = min(50, total_available)
-
-        for subj, subj_questions in all_loaded_questions.items():
-            if not subj_questions: continue
-            proportion = len(subj_questions) / total_available if total_available > 0 else 0
-            count = max(1, round(target_total * proportion)) if total_available > 0 else min(10, len(subj_questions))
-            actual_count = min(count, len(subj_questions))
-            if actual_count > 0:
-                temp_list.extend(random.sample(subj_questions, actual_count))
-        
-        questions_to_ask = temp_list
-        random.shuffle(questions_to_ask)
-        logger.info(f"User {user_id} selected random questions. Prepared {len(questions_to_ask)} questions.")
+        # A uniform sample over all subjects mixes them in proportion to their size, already shuffled
+        questions_to_ask = random.sample(range(len(context.bot_data['questions_flat'])), k=random_mix_size)
+        logger.info("User %s selected random questions. Prepared %s questions.", user_id, len(questions_to_ask))
     else:
-        logger.warning(f"Received unexpected callback data in start_quiz state: {data}")
+        logger.warning("Received unexpected callback data in start_quiz state: %s", data)
         await query.edit_message_text("Uzr , kutilmagan xato , botni qayta ishga tushuring /start")
         return ConversationHandler.END
 
     if not questions_to_ask:
-        logger.error(f"Failed to prepare any questions for user {user_id} for selection '{data}'.")
+        logger.error("Failed to prepare any questions for user %s for selection '%s'.", user_id, data)
         await query.edit_message_text("Uzr, savollar topilmadi.")
         return ConversationHandler.END
 
-    context.user_data['subject'] = subject_name
-    context.user_data['questions'] = questions_to_ask
-    context.user_data['index'] = 0
-    context.user_data['score'] = 0
-    context.user_data['answered_in_batch'] = set()
-    context.user_data['current_batch_indices'] = []
+    quiz_sessions[user_id] = QuizSession(subject_name, array('H', questions_to_ask))
 
     await query.edit_message_text(f"Test boshlanmoqda: {subject_name}")
     await send_next_question_batch(update, context)
     return QUIZ_IN_PROGRESS
 
+async def send_question_message(bot, kwargs: dict):
+    """Sends one question message, waiting out Telegram's flood control up to SEND_MAX_RETRIES times."""
+    for _ in range(SEND_MAX_RETRIES):
+        try:
+            return await bot.send_message(**kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after # Seconds, or a timedelta in newer PTB versions
+            await asyncio.sleep(retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after)
+    return await bot.send_message(**kwargs)
+
 async def send_next_question_batch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int | None:
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    current_index = context.user_data.get('index', 0)
-    questions = context.user_data.get('questions', [])
-    total_questions = len(questions)
+    session = get_quiz_session(user_id)
+
+    if not session or not session.question_ids:
+        logger.error("send_next_question_batch: No questions found for user %s.", user_id)
+        await context.bot.send_message(chat_id=chat_id, text="Xatolik: savollar topilmadi.")
+        quiz_sessions.pop(user_id, None)
+        return ConversationHandler.END
+
+    current_index = session.index
+    question_ids = session.question_ids
+    total_questions = len(question_ids)
 
     if current_index >= total_questions:
-        logger.info(f"send_next_question_batch: No more questions to send for user {user_id}.")
+        logger.debug("send_next_question_batch: No more questions to send for user %s.", user_id)
+        quiz_sessions.pop(user_id, None)
         await context.bot.send_message(chat_id=chat_id, text="Barcha savollarga javob berdingiz!")
         reply_markup = get_start_keyboard(context)
         if reply_markup:
             await context.bot.send_message(chat_id=chat_id, text="Yangi fanni tanlash?", reply_markup=reply_markup)
         return SELECTING_SUBJECT
 
-    if not questions:
-        logger.error(f"send_next_question_batch: No questions found for user {user_id}.")
-        await context.bot.send_message(chat_id=chat_id, text="Xatolik: savollar topilmadi.")
-        context.user_data.clear()
-        return ConversationHandler.END
-
     end_index = min(current_index + QUESTIONS_PER_BATCH, total_questions)
-    batch_indices = list(range(current_index, end_index))
-    batch_questions = questions[current_index:end_index]
-
-    context.user_data['current_batch_indices'] = batch_indices
-    context.user_data['answered_in_batch'] = set()
-    logger.info(f"Sending questions {current_index + 1}-{end_index} to user {user_id}. Batch indices: {batch_indices}")
-
-    for i, q_data in enumerate(batch_questions):
-        question_global_index = batch_indices[i]
-        options_buttons = []
-        options_text_parts = []
-
-        valid_options = [opt for opt in q_data.get('options', []) if isinstance(opt, str) and len(opt) > 2 and opt[1] == ')']
-        if not valid_options:
-            logger.error(f"Q {question_global_index} user {user_id} invalid options: {q_data.get('options')}")
-            await context.bot.send_message(chat_id=chat_id, text=f"Q {question_global_index + 1} o'tkazib yuborildi (xato variantlar).")
-            context.user_data['answered_in_batch'].add(question_global_index)
-            continue
-
-        for opt in valid_options:
-            option_letter = opt[0].upper()
-            options_text_parts.append(f"{opt}")
-            callback_data = f"ans|{question_global_index}|{option_letter}"
-            options_buttons.append(InlineKeyboardButton(text=option_letter, callback_data=callback_data))
-        
-        question_text_body = q_data.get('question', 'Xatolik: Savol matni yo\'q')
-        options_text_formatted = "\n".join(options_text_parts)
-        full_message_text = f"{question_global_index + 1}. {question_text_body}\n\n{options_text_formatted}"
-        
-        keyboard = [options_buttons]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=full_message_text,
-            reply_markup=reply_markup
-        )
-
-    context.user_data['index'] = end_index
+    batch_indices = range(current_index, end_index)
+
+    session.batch_start = current_index
+    session.batch_len = end_index - current_index
+    session.answered_mask = 0
+    logger.debug("Sending questions %s-%s to user %s.", current_index + 1, end_index, user_id)
+
+    messages = [] # (question_global_index, send_message kwargs), sent concurrently below
+    questions_flat = context.bot_data['questions_flat']
+    for question_global_index in batch_indices:
+        q_data = questions_flat[question_ids[question_global_index]]
+        full_message_text = f"{question_global_index + 1}. {q_data.question}\n\n{q_data.options_text}"
+        reply_markup = get_answer_keyboard(question_global_index, q_data.letters)
+        messages.append((question_global_index, {'chat_id': chat_id, 'text': full_message_text, 'reply_markup': reply_markup}))
+
+    for chunk_start in range(0, len(messages), SEND_CHUNK_SIZE):
+        if chunk_start:
+            await asyncio.sleep(SEND_CHUNK_DELAY)
+        chunk = messages[chunk_start:chunk_start + SEND_CHUNK_SIZE]
+        results = await asyncio.gather(*(send_question_message(context.bot, kwargs) for _, kwargs in chunk), return_exceptions=True)
+        for (question_global_index, _), result in zip(chunk, results):
+            if isinstance(result, Exception):
+                logger.error("Failed to send question %s to user %s: %s", question_global_index, user_id, result)
+                session.answered_mask |= 1 << (question_global_index - current_index) # Don't block the batch on an undeliverable question
+                session.unsent_count += 1
+
+    session.index = end_index
 
     if end_index < total_questions:
-        next_button_keyboard = [[InlineKeyboardButton("Keyingi testlar", callback_data="next")]] # Changed text for clarity
         await context.bot.send_message(
             chat_id=chat_id,
             text="Barcha savollarga javob berib bo'lgach, keyingisiga o'ting...",
-            reply_markup=InlineKeyboardMarkup(next_button_keyboard)
+            reply_markup=NEXT_BATCH_MARKUP
         )
     return QUIZ_IN_PROGRESS
 
+async def show_answer_feedback(query, text: str, session: QuizSession, user_id: int, qid: int, selected_letter: str) -> None:
+    """
+    Replaces an answered question's buttons with the feedback text.
+    If the edit fails, the selected letter is forgotten so tapping the same option again retries it.
+    """
+    try:
+        await query.edit_message_text(text=text, reply_markup=None)
+    except BadRequest as e:
+        if "Message is not modified" not in str(e):
+            logger.warning("Could not edit message user %s, qid %s: %s", user_id, qid, e)
+            forget_selected_letter(session, qid, selected_letter)
+    except Exception:
+        forget_selected_letter(session, qid, selected_letter) # e.g. TimedOut/NetworkError; still reported to error_handler
+        raise
+
+def forget_selected_letter(session: QuizSession, qid: int, selected_letter: str) -> None:
+    """Drops the recorded answer for `qid`, unless a newer tap has already replaced it."""
+    if session.selected_letters.get(qid) == selected_letter:
+        del session.selected_letters[qid]
+
 async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    await query.answer()
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
 
     try:
-        _, qid_str, selected_letter = query.data.split("|")
-        qid = int(qid_str)
+        qid, selected_letter = decode_answer_callback(query.data)
     except (ValueError, IndexError):
-        logger.error(f"Invalid callback data in handle_answer: {query.data}")
+        logger.error("Invalid callback data in handle_answer: %s", query.data)
+        await query.answer()
         try: await query.edit_message_text("Uzr, noto'g'ri tugma va javob formati.")
         except BadRequest: pass
         return QUIZ_IN_PROGRESS
 
-    questions = context.user_data.get("questions", [])
-    total_questions = len(questions)
-    current_batch_indices = context.user_data.get("current_batch_indices", [])
-    answered_in_batch = context.user_data.get("answered_in_batch", set())
+    session = get_quiz_session(user_id)
+    question_ids = session.question_ids if session else ()
+    total_questions = len(question_ids)
 
-    if not questions or qid >= total_questions:
-        logger.error(f"handle_answer: Invalid questions/qid {qid} for user {user_id}.")
+    if not question_ids or not 0 <= qid < total_questions:
+        logger.error("handle_answer: Invalid questions/qid %s for user %s.", qid, user_id)
+        await query.answer()
         try: await query.edit_message_text("Uzr, savollarni yuklashda xatolik.")
         except BadRequest: pass
-        context.user_data.clear()
+        quiz_sessions.pop(user_id, None)
         return ConversationHandler.END
 
-    if qid in current_batch_indices:
-        if qid not in answered_in_batch:
-            answered_in_batch.add(qid)
-            context.user_data['answered_in_batch'] = answered_in_batch
-            logger.info(f"User {user_id} answered question {qid} in current batch. Batch answered: {len(answered_in_batch)}/{len(current_batch_indices)}")
-        else:
-            logger.info(f"User {user_id} re-answered question {qid} in current batch.")
-    else:
-        logger.warning(f"User {user_id} answered question {qid} which is not in current batch {current_batch_indices}.")
-
-    question_data = questions[qid]
-    correct_answer_letter = question_data.get('correct')
-    question_text = question_data.get('question', '[Savol yo\'q]')
-
-    options_text_parts = []
-    selected_option_text = f"({selected_letter})"
-    correct_option_text = f"({correct_answer_letter})"
-    valid_options = question_data.get('options', [])
-    for opt in valid_options:
-        if isinstance(opt, str) and len(opt) > 0:
-            options_text_parts.append(opt)
-            if opt.startswith(selected_letter): selected_option_text = opt
-            if opt.startswith(correct_answer_letter): correct_option_text = opt
-    options_text_formatted = "\n".join(options_text_parts)
-
-    feedback = ""
-    correctly_answered_key = f"correct_{qid}"
+    question_data = context.bot_data['questions_flat'][question_ids[qid]]
+    feedback_text = question_data.feedback_texts.get(selected_letter)
+    if feedback_text is None:
+        logger.error("handle_answer: Unknown option %s for qid %s from user %s.", selected_letter, qid, user_id)
+        await query.answer()
+        return QUIZ_IN_PROGRESS
+
+    correct_answer_letter = question_data.correct
     is_correct = (selected_letter == correct_answer_letter)
+    verdict = "✅ To'g'ri!" if is_correct else f"❌ Xato! To'g'ri javob: {correct_answer_letter}"
 
-    if is_correct:
-        feedback = "✅ To'g'ri!"
-        if not context.user_data.get(correctly_answered_key, False):
-            context.user_data['score'] = context.user_data.get('score', 0) + 1
-            context.user_data[correctly_answered_key] = True
-            logger.info(f"User {user_id} answered Q {qid} correctly. Score: {context.user_data['score']}")
+    if session.selected_letters.get(qid) == selected_letter:
+        logger.debug("User %s repeated answer %s for question %s. Skipping the edit.", user_id, selected_letter, qid)
+        await query.answer(text=verdict) # Double tap: the message already shows (or is being edited to show) this answer
+        return QUIZ_IN_PROGRESS
+
+    batch_offset = qid - session.batch_start
+    if 0 <= batch_offset < session.batch_len:
+        answered_bit = 1 << batch_offset
+        if not session.answered_mask & answered_bit:
+            session.answered_mask |= answered_bit
+            if logger.isEnabledFor(logging.DEBUG): # Skips the bit count when debug logging is off
+                logger.debug("User %s answered question %s in current batch. Batch answered: %s/%s", user_id, qid, session.answered_mask.bit_count(), session.batch_len)
         else:
-            logger.info(f"User {user_id} re-answered Q {qid} correctly. Score not changed.")
+            logger.debug("User %s re-answered question %s in current batch.", user_id, qid)
     else:
-        feedback = f"❌ Xato! To'g'ri javob: {correct_option_text}"
-    
-    updated_text = (
-        f"{qid + 1}. {question_text}\n\n"
-        f"{options_text_formatted}\n\n"
-        f"--------------------\n"
-        f"{feedback}\n"
-        f"Siz tanladingiz: {selected_option_text}"
+        logger.warning("User %s answered question %s which is not in current batch starting at %s.", user_id, qid, session.batch_start)
+
+    # Only the first answer counts: the toast reveals the correct letter before the buttons are gone
+    if qid not in session.scored_questions:
+        session.scored_questions.add(qid)
+        if is_correct:
+            session.score += 1
+        logger.debug("User %s answered Q %s (correct: %s). Score: %s", user_id, qid, is_correct, session.score)
+    else:
+        logger.debug("User %s re-answered Q %s. Score not changed.", user_id, qid)
+
+    # The edit that removes the buttons is started first and runs in the background; the verdict
+    # goes out meanwhile with the (mandatory) callback answer as a toast.
+    updated_text = f"{qid + 1}. {feedback_text}" # Precomputed per option letter in build_feedback_texts
+    context.application.create_task(
+        show_answer_feedback(query, updated_text, session, user_id, qid, selected_letter), update=update
     )
+    session.selected_letters[qid] = selected_letter # Only once the edit is under way; show_answer_feedback forgets it on failure
     try:
-        await query.edit_message_text(text=updated_text, reply_markup=None)
-    except BadRequest as e:
-        if "Message is not modified" not in str(e):
-            logger.warning(f"Could not edit message user {user_id}, qid {qid}: {e}")
+        await query.answer(text=verdict)
+    except TelegramError as e: # e.g. "Query is too old"; the edit above still shows the verdict
+        logger.warning("Could not answer callback query of user %s, qid %s: %s", user_id, qid, e)
 
-    is_last_batch = (total_questions - 1) in current_batch_indices
-    all_in_batch_answered = len(answered_in_batch) >= len(current_batch_indices)
+    is_last_batch = session.batch_start + session.batch_len == total_questions
+    all_in_batch_answered = session.answered_mask == (1 << session.batch_len) - 1
 
     if is_last_batch and all_in_batch_answered:
-        score = context.user_data.get('score', 0)
-        logger.info(f"User {user_id} finished the final batch. Quiz finished. Score: {score}/{total_questions}")
+        score = session.score
+        scored_total = total_questions - session.unsent_count # Undelivered questions don't count against the user
+        logger.info("User %s finished the final batch. Quiz finished. Score: %s/%s", user_id, score, scored_total)
+        quiz_sessions.pop(user_id, None)
         
         reply_markup = get_start_keyboard(context)
-        finish_text = f"Test tugadi!\nSizning natijangiz: {score}/{total_questions}\n\nYangi fan tanlash?"
+        result_text = f"Test tugadi!\nSizning natijangiz: {score}/{scored_total}"
+        if session.unsent_count:
+            result_text += f"\n({session.unsent_count} ta savol yuborilmadi va hisobga olinmadi)"
+        finish_text = f"{result_text}\n\nYangi fan tanlash?"
         if not reply_markup:
-            finish_text = f"Test tugadi!\nSizning natijangiz: {score}/{total_questions}\n(Fan tanlashda xatolik, botni /start bilan qayta ishga tushiring)"
+            finish_text = f"{result_text}\n(Fan tanlashda xatolik, botni /start bilan qayta ishga tushiring)"
         
         await context.bot.send_message(chat_id=chat_id, text=finish_text, reply_markup=reply_markup)
         return SELECTING_SUBJECT
@@ -561,18 +741,19 @@ async def handle_next(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     await query.answer()
     user_id = update.effective_user.id
 
-    current_batch_indices = context.user_data.get("current_batch_indices", [])
-    answered_in_batch = context.user_data.get("answered_in_batch", set())
+    session = get_quiz_session(user_id)
+    batch_len = session.batch_len if session else 0
+    answered_count = session.answered_mask.bit_count() if session else 0
 
-    if len(answered_in_batch) >= len(current_batch_indices):
-        logger.info(f"User {user_id} finished batch {current_batch_indices}, proceeding to next.")
+    if answered_count >= batch_len:
+        logger.debug("User %s finished the current batch, proceeding to next.", user_id)
         try: await query.delete_message()
-        except BadRequest as e: logger.warning(f"Could not delete 'Next Batch' prompt: {e}")
+        except BadRequest as e: logger.warning("Could not delete 'Next Batch' prompt: %s", e)
         return await send_next_question_batch(update, context)
     else:
-        remaining_count = len(current_batch_indices) - len(answered_in_batch)
+        remaining_count = batch_len - answered_count
         plural = "ta" # Uzbek doesn't typically pluralize with 's' for count
-        logger.info(f"User {user_id} clicked 'Next Batch' prematurely. Answered: {len(answered_in_batch)}/{len(current_batch_indices)}")
+        logger.debug("User %s clicked 'Next Batch' prematurely. Answered: %s/%s", user_id, answered_count, batch_len)
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=f"Iltimos, qolgan {remaining_count} {plural} savolga javob bering!"
@@ -592,9 +773,24 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         try: await update.callback_query.edit_message_reply_markup(reply_markup=None)
         except BadRequest: pass
     
-    context.user_data.clear()
+    if user: quiz_sessions.pop(user.id, None)
     return ConversationHandler.END
 
+def make_callback_dispatcher(routes: dict):
+    """
+    Returns a callback query handler that picks the handler from `routes` by the first character of the data.
+    Every callback kind has its own first character, so one dict lookup replaces a regex match per registered handler.
+    """
+    async def dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int | None:
+        query = update.callback_query
+        handler = routes.get((query.data or "")[:1]) # data is None for game callbacks
+        if handler is None:
+            logger.warning("Ignoring callback data not expected in this state: %s", query.data)
+            await query.answer()
+            return None # Stay in the current state
+        return await handler(update, context)
+    return dispatch
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error("Exception while handling an update:", exc_info=context.error)
     if isinstance(update, Update) and update.effective_message:
@@ -602,48 +798,109 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
             if not isinstance(context.error, BadRequest) or "Message is not modified" not in str(context.error):
                 await update.effective_message.reply_text("Uzr, kutilmagan xato yuz berdi. /start buyrug'ini bosib qayta uruning.")
         except Exception as e:
-            logger.error(f"Failed to send error message to user: {e}")
-
-# === Flask App Setup ===
-flask_app = Flask(__name__)
-
-@flask_app.route("/")
-def index():
-    return "Quiz Bot is alive!"
-
-@flask_app.route(f"/{WEBHOOK_PATH}", methods=["POST"])
-async def telegram_webhook():
-    if request.is_json:
-        update_data = request.get_json()
-        # Log the raw update data for debugging if needed
-        # logger.debug(f"Webhook received JSON data: {update_data}")
-        update = Update.de_json(update_data, application.bot)
-        async with application: # Ensure context for async operations
-            await application.process_update(update)
-        return Response("OK", status=200)
-    else:
-        logger.warning("Webhook received non-JSON request.")
-        return Response("Bad Request", status=400)
+            logger.error("Failed to send error message to user: %s", e)
+
+# === Bot API Requests ===
+class OrjsonHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Bot API responses with orjson instead of the stdlib json module."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # Let PTB handle what orjson rejects (e.g. invalid UTF-8) and raise its usual error
+            return HTTPXRequest.parse_json_payload(payload)
+
+# === Webhook Server ===
+class LivenessHandler(tornado.web.RequestHandler):
+    """Answers health checks and uptime pingers on "/", as the old Flask app did."""
+
+    def get(self) -> None:
+        self.write("Quiz Bot is alive!")
+
+    def head(self) -> None:
+        pass
+
+class WebhookUpdateHandler(tornado.web.RequestHandler):
+    """Queues each update Telegram POSTs to the webhook path for the application to process."""
+
+    async def post(self) -> None:
+        try:
+            update = Update.de_json(orjson.loads(self.request.body), application.bot)
+        except Exception as e:
+            logger.warning("Rejecting malformed webhook payload: %s", e)
+            self.set_status(400)
+            return
+        await application.update_queue.put(update)
+
+async def run_webhook_server() -> None:
+    """Serves the webhook and the liveness route on PORT until SIGINT/SIGTERM."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass # Windows: Ctrl+C raises KeyboardInterrupt instead
+    web_app = tornado.web.Application([
+        (r"/", LivenessHandler),
+        (rf"/{WEBHOOK_PATH}/?", WebhookUpdateHandler),
+    ])
+    server = web_app.listen(PORT, address="0.0.0.0")
+    try:
+        async with application: # initialize() / shutdown()
+            await application.bot.set_webhook(url=WEBHOOK_FULL_URL, allowed_updates=Update.ALL_TYPES)
+            await application.start()
+            await stop_event.wait()
+            await application.stop()
+    finally:
+        server.stop()
 
 # === Main Application Setup ===
 loaded_questions = load_questions(QUIZ_FILE)
 if not loaded_questions:
-    logger.critical(f"CRITICAL: No questions loaded from {QUIZ_FILE}. Bot may not function correctly.")
-
-application = ApplicationBuilder().token(TOKEN).build()
+    logger.critical("CRITICAL: No questions loaded from %s. Bot may not function correctly.", QUIZ_FILE)
+
+application = (
+    ApplicationBuilder()
+    .token(TOKEN)
+    .request(OrjsonHTTPXRequest(
+        connection_pool_size=256, # 256 is PTB's default pool size for bot requests
+        pool_timeout=5.0, # Wait for a free keep-alive connection during send bursts instead of failing after 1s
+    ))
+    .get_updates_request(OrjsonHTTPXRequest())
+    .build()
+)
 application.bot_data['questions'] = loaded_questions
-logger.info(f"Stored {len(loaded_questions)} subjects in bot_data.")
+# All questions in one list; quiz sessions only keep indices into it. Each subject owns a contiguous range.
+questions_flat = []
+subject_question_ids = {}
+for subject, subject_questions in list(loaded_questions.items()):
+    room = MAX_QUIZ_QUESTIONS - len(questions_flat)
+    if len(subject_questions) > room:
+        logger.error("Question pool is limited to %s questions; dropping %s of %s questions from subject '%s'.",
+                     MAX_QUIZ_QUESTIONS, len(subject_questions) - room, len(subject_questions), subject)
+        if room == 0:
+            del loaded_questions[subject]
+            continue
+        subject_questions = loaded_questions[subject] = subject_questions[:room]
+    subject_question_ids[subject] = range(len(questions_flat), len(questions_flat) + len(subject_questions))
+    questions_flat.extend(subject_questions)
+application.bot_data['questions_flat'] = questions_flat
+application.bot_data['subject_question_ids'] = subject_question_ids
+application.bot_data['random_mix_size'] = min(RANDOM_MIX_SIZE, len(questions_flat))
+application.bot_data['start_markup'] = build_start_keyboard(loaded_questions) # Subjects don't change while running
+logger.info("Stored %s subjects in bot_data.", len(loaded_questions))
 
 conv_handler = ConversationHandler(
     entry_points=[CommandHandler("start", start)],
     states={
         SELECTING_SUBJECT: [
-            CallbackQueryHandler(start_quiz, pattern="^subj\\|"),
-            CallbackQueryHandler(start_quiz, pattern="^random$")
+            CallbackQueryHandler(make_callback_dispatcher({'s': start_quiz, 'r': start_quiz})) # "s|<subject>", "r"
         ],
         QUIZ_IN_PROGRESS: [
-            CallbackQueryHandler(handle_answer, pattern="^ans\\|"),
-            CallbackQueryHandler(handle_next, pattern="^next$")
+            CallbackQueryHandler(make_callback_dispatcher({'a': handle_answer, 'n': handle_next})) # "a<qid><letter>", "n"
         ],
     },
     fallbacks=[CommandHandler("start", start), CommandHandler("cancel", cancel)], # Added cancel to fallbacks
@@ -659,50 +916,22 @@ application.add_handler(CommandHandler("addsubscriber", add_subscriber_command))
 application.add_error_handler(error_handler)
 
 # === Running the Application ===
-async def setup_webhook():
-    logger.info(f"Attempting to set webhook to: {WEBHOOK_FULL_URL}")
-    if not WEBHOOK_FULL_URL:
-        logger.error("WEBHOOK_FULL_URL is not defined. Cannot set webhook.")
-        return False
-    try:
-        await application.initialize()
-        webhook_info = await application.bot.get_webhook_info()
-        if webhook_info.url != WEBHOOK_FULL_URL:
-            logger.info(f"Webhook currently set to '{webhook_info.url}'. Setting to '{WEBHOOK_FULL_URL}'...")
-            await application.bot.set_webhook(url=WEBHOOK_FULL_URL, allowed_updates=Update.ALL_TYPES)
-            new_webhook_info = await application.bot.get_webhook_info()
-            if new_webhook_info.url == WEBHOOK_FULL_URL:
-                logger.info("Webhook set successfully.")
-                return True
-            else:
-                logger.error(f"Failed to set webhook. Current URL: {new_webhook_info.url}")
-                return False
-        else:
-            logger.info("Webhook is already set correctly.")
-            return True
-    except Exception as e:
-        logger.error(f"Exception during webhook setup: {e}", exc_info=True)
-        return False
-
-async def main_async_setup():
-    if WEBHOOK_MODE:
-        logger.info("Running webhook setup...")
-        await setup_webhook()
-    else:
-        logger.info("Polling mode enabled. Skipping webhook setup.")
-
 if __name__ == "__main__":
     try:
-        asyncio.run(main_async_setup())
-    except Exception as e:
-        logger.error(f"Error during initial async setup: {e}", exc_info=True)
+        import uvloop # Not available on Windows; asyncio's default loop is used there
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("Using uvloop event loop.")
+    except ImportError:
+        pass
 
     if WEBHOOK_MODE:
-        logger.info(f"Starting Flask server on host 0.0.0.0 port {PORT} for webhook...")
-        # For production, consider using a WSGI server like gunicorn or waitress
-        # from waitress import serve
-        # serve(flask_app, host='0.0.0.0', port=PORT)
-        flask_app.run(host="0.0.0.0", port=PORT, debug=False) # debug=False for production
+        # A small tornado server rather than run_webhook(), whose server only routes the
+        # webhook path, so that "/" keeps answering Render health checks and pingers.
+        logger.info("Starting webhook server on host 0.0.0.0 port %s, webhook URL: %s", PORT, WEBHOOK_FULL_URL)
+        try:
+            asyncio.run(run_webhook_server())
+        except KeyboardInterrupt:
+            logger.info("Webhook server stopped manually.")
     else:
         logger.info("Starting bot polling...")
         try:
@@ -710,4 +939,4 @@ if __name__ == "__main__":
         except KeyboardInterrupt:
             logger.info("Polling stopped manually.")
         except Exception as e:
-            logger.error(f"Error during polling: {e}", exc_info=True)
\ No newline at end of file
+            logger.error("Error during polling: %s", e, exc_info=True)